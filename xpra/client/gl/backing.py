@@ -384,8 +384,8 @@ class GLWindowBackingBase(WindowBackingBase):
         # Create and assign fragment programs
         from OpenGL.GL import GL_FRAGMENT_SHADER, GL_VERTEX_SHADER
         vertex_shader = self.gl_init_shader("vertex", GL_VERTEX_SHADER)
-        from xpra.client.gl.shaders import SOURCE
-        for name, source in SOURCE.items():
+        from xpra.client.gl.shaders import SHADER_NAMES
+        for name in SHADER_NAMES:
             if name in ("overlay", "vertex", "fixed-color"):
                 continue
             fragment_shader = self.gl_init_shader(name, GL_FRAGMENT_SHADER)
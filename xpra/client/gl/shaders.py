@@ -24,6 +24,8 @@
 # G = Y - (a * e / b) * Cr - (c * d / b) * Cb
 # B = Y + d * Cb
 
+from functools import lru_cache
+
 from xpra.codecs.constants import get_subsampling_divs
 
 GLSL_VERSION = "330 core"
@@ -35,26 +37,51 @@ CS_MULTIPLIERS = {
 }
 
 
-def gen_YUV_to_RGB(divs: tuple[tuple[int, int], ...], cs="bt601", full_range=True):
+@lru_cache(maxsize=None)
+def gen_csc_constants(cs="bt601", full_range=True) -> str:
+    # generate the colorspace conversion as a single constant matrix
+    # plus a bias vector (from the -0.5 U / V offset),
+    # so the GPU can issue vec-wide fused multiply-adds:
     if cs not in CS_MULTIPLIERS:
         raise ValueError(f"unsupported colorspace {cs}")
     a, b, c, d, e = CS_MULTIPLIERS[cs]
     f = - c * d / b
     g = - a * e / b
-    ymult = "" if full_range else " * 1.1643835616438356"
-    umult = vmult = "" if full_range else " * 1.1383928571428572"
+    ymult = 1 if full_range else 1.1643835616438356
+    uvmult = 1 if full_range else 1.1383928571428572
+    # RGB rows as functions of (y, u, v),
+    # with the narrow-range multipliers folded into the coefficients:
+    rows = (
+        (ymult, 0, e * uvmult),
+        (ymult, f * uvmult, g * uvmult),
+        (ymult, d * uvmult, 0),
+    )
+    # mat3 constructor arguments are in column-major order:
+    matrix = ", ".join(str(rows[row][col]) for col in range(3) for row in range(3))
+    bias = ", ".join(str(-0.5 * (row[1] + row[2])) for row in rows)
+    return f"""
+const mat3 CSC = mat3({matrix});
+const vec3 BIAS = vec3({bias});
+"""
+
+
+@lru_cache(maxsize=None)
+def gen_YUV_to_RGB(divs: tuple[tuple[int, int], ...], cs="bt601", full_range=True):
+    csc = gen_csc_constants(cs, full_range)
     defines = []
 
     def add_div(name: str, xdiv=1, ydiv=1):
+        # divisions are expensive on GPUs,
+        # so emit the reciprocal and multiply instead:
         if xdiv == ydiv:
-            # just divide by the same integer:
-            # ie: "#define Ydiv 1"
-            value = xdiv
+            # just multiply by the same value:
+            # ie: "#define Yrcp 1.0"
+            value = f"{1 / xdiv}"
         else:
             # store each component in a vector:
-            # ie: "#define Udiv vec2(2, 1)"
-            value = f"vec2({xdiv}, {ydiv})"
-        defines.append(f"{name}div {value}")
+            # ie: "#define Urcp vec2(0.5, 1.0)"
+            value = f"vec2({1 / xdiv}, {1 / ydiv})"
+        defines.append(f"{name}rcp {value}")
 
     for i, div in enumerate(divs):
         add_div("YUV"[i], *div)
@@ -62,8 +89,10 @@ def gen_YUV_to_RGB(divs: tuple[tuple[int, int], ...], cs="bt601", full_range=Tru
     defines_str = "\n".join(f"#define {define}" for define in defines)
     return f"""
 #version {GLSL_VERSION}
+precision mediump float;
 layout(origin_upper_left) in vec4 gl_FragCoord;
 {defines_str}
+{csc}
 uniform vec2 viewport_pos;
 uniform vec2 scaling;
 uniform sampler2DRect Y;
@@ -73,29 +102,25 @@ layout(location = 0) out vec4 frag_color;
 
 void main()
 {{
-    vec2 pos = (gl_FragCoord.xy-viewport_pos.xy)/scaling;
-    highp float y = texture(Y, pos/Ydiv).r {ymult};
-    highp float u = (texture(U, pos/Udiv).r - 0.5) {umult};
-    highp float v = (texture(V, pos/Vdiv).r - 0.5) {vmult};
-
-    highp float r = y +           {e} * v;
-    highp float g = y + {f} * u + {g} * v;
-    highp float b = y + {d} * u;
+    highp vec2 inv_scaling = 1.0/scaling;
+    highp vec2 pos = (gl_FragCoord.xy-viewport_pos.xy) * inv_scaling;
+    mediump float y = texture(Y, pos*Yrcp).r;
+    mediump float u = texture(U, pos*Urcp).r;
+    mediump float v = texture(V, pos*Vrcp).r;
 
-    frag_color = vec4(r, g, b, 1.0);
+    frag_color = vec4(CSC * vec3(y, u, v) + BIAS, 1.0);
 }}
 """
 
 
+@lru_cache(maxsize=None)
 def gen_NV12_to_RGB(cs="bt601"):
-    if cs not in CS_MULTIPLIERS:
-        raise ValueError(f"unsupported colorspace {cs}")
-    a, b, c, d, e = CS_MULTIPLIERS[cs]
-    f = - c * d / b
-    g = - a * e / b
+    csc = gen_csc_constants(cs, full_range=True)
     return f"""
 #version {GLSL_VERSION}
+precision mediump float;
 layout(origin_upper_left) in vec4 gl_FragCoord;
+{csc}
 uniform vec2 viewport_pos;
 uniform vec2 scaling;
 uniform sampler2DRect Y;
@@ -104,16 +129,11 @@ layout(location = 0) out vec4 frag_color;
 
 void main()
 {{
-    vec2 pos = (gl_FragCoord.xy-viewport_pos.xy)/scaling;
-    highp float y = texture(Y, pos).r;
-    highp float u = texture(UV, pos).r - 0.5;
-    highp float v = texture(UV, pos).g - 0.5;
-
-    highp float r = y +           {e} * v;
-    highp float g = y + {f} * u + {g} * v;
-    highp float b = y + {d} * u;
+    highp vec2 pos = (gl_FragCoord.xy-viewport_pos.xy) * (1.0/scaling);
+    mediump float y = texture(Y, pos).r;
+    mediump vec2 uv = texture(UV, pos).rg;
 
-    frag_color = vec4(r, g, b, 1.0);
+    frag_color = vec4(CSC * vec3(y, uv) + BIAS, 1.0);
 }}
 """
 
@@ -156,14 +176,33 @@ void main()
 }}
 """
 
-SOURCE = {
+YUV_FORMATS = ("YUV420P", "YUV422P", "YUV444P")
+
+SHADER_NAMES = ("vertex", "overlay", "fixed-color", "NV12_to_RGB") + tuple(
+    f"{fmt}_to_RGB{rng}" for fmt in YUV_FORMATS for rng in ("", "_FULL")
+)
+
+
+class _LazyShaderDict(dict):
+    # generate shader sources on first access,
+    # so that merely importing this module
+    # does not pay for building every YUV variant
+
+    def __missing__(self, key: str) -> str:
+        if key == "NV12_to_RGB":
+            src = gen_NV12_to_RGB()
+        elif key in SHADER_NAMES:
+            fmt = key.split("_to_RGB")[0]
+            divs = get_subsampling_divs(fmt)
+            src = gen_YUV_to_RGB(divs, full_range=key.endswith("_FULL"))
+        else:
+            raise KeyError(key)
+        self[key] = src
+        return src
+
+
+SOURCE = _LazyShaderDict({
     "vertex": VERTEX_SHADER,
     "overlay": OVERLAY_SHADER,
     "fixed-color": FIXED_COLOR_SHADER,
-    "NV12_to_RGB": gen_NV12_to_RGB(),
-}
-
-for fmt in ("YUV420P", "YUV422P", "YUV444P"):
-    divs = get_subsampling_divs(fmt)
-    SOURCE[f"{fmt}_to_RGB"] = gen_YUV_to_RGB(divs, full_range=False)
-    SOURCE[f"{fmt}_to_RGB_FULL"] = gen_YUV_to_RGB(divs, full_range=True)
+})
@@ -5,12 +5,16 @@
 
 import os
 import re
+import hashlib
+from collections import OrderedDict
 from collections.abc import Callable
+from functools import lru_cache
 
 from xpra.util.str_fn import repr_ellipsized, bytestostr
 from xpra.util.env import envbool, IgnoreWarningsContext
 from xpra.os_util import OSX, gi_import
 from xpra.codecs.icon_util import INKSCAPE_RE
+from xpra.codecs.loader import get_encoding_help, get_encoding_name
 from xpra.gtk.widget import scaled_image, menuitem
 from xpra.gtk.pixbuf import get_pixbuf_from_data
 from xpra.gtk.dialogs.about import about, close_about
@@ -22,6 +26,10 @@ log = Logger("menu")
 
 Gtk = gi_import("Gtk")
 GdkPixbuf = gi_import("GdkPixbuf")
+Gio = gi_import("Gio")
+GLib = gi_import("GLib")
+
+INKSCAPE_PATTERN = re.compile(INKSCAPE_RE)
 
 MENU_ICONS = envbool("XPRA_MENU_ICONS", True)
 HIDE_DISABLED_MENU_ENTRIES = envbool("XPRA_HIDE_DISABLED_MENU_ENTRIES", False)
@@ -93,19 +101,67 @@ def set_sensitive(widget, sensitive: bool) -> None:
 
 
 def load_pixbuf(data) -> GdkPixbuf.Pixbuf:
+    try:
+        # decoding from a stream avoids copying the data
+        # through the incremental PixbufLoader machinery:
+        stream = Gio.MemoryInputStream.new_from_bytes(GLib.Bytes.new_take(data))
+        return GdkPixbuf.Pixbuf.new_from_stream(stream, None)
+    except Exception:
+        log("new_from_stream(..) failed, retrying with a PixbufLoader", exc_info=True)
     loader = GdkPixbuf.PixbufLoader()
     loader.write(data)
     loader.close()
     return loader.get_pixbuf()
 
 
+@lru_cache(maxsize=1)
+def get_icon_filenames() -> frozenset:
+    # cache the icon directory listing,
+    # so that checking for candidate icons is a set lookup
+    # instead of a stat call per menu item.
+    # call 'get_icon_filenames.cache_clear()' to invalidate,
+    # ie: from a theme change handler
+    try:
+        return frozenset(os.listdir(get_icon_dir()))
+    except OSError:
+        return frozenset()
+
+
+# cache the decoded pixbufs so that rebuilding the same menus
+# does not have to decode the same icon data over and over again:
+_APPIMAGE_CACHE: OrderedDict[tuple, GdkPixbuf.Pixbuf] = OrderedDict()
+_APPIMAGE_CACHE_SIZE = 256
+
+
 def get_appimage(app_name, icondata=None, menu_icon_size=24) -> Gtk.Image | None:
+    key = (
+        bytestostr(app_name or ""),
+        hashlib.blake2b(icondata, digest_size=16).digest() if icondata else None,
+        menu_icon_size,
+    )
+    pixbuf = _APPIMAGE_CACHE.get(key)
+    if pixbuf:
+        _APPIMAGE_CACHE.move_to_end(key)
+        # the pixbuf is already scaled, but widgets cannot be shared,
+        # so always wrap it in a fresh image widget:
+        return scaled_image(pixbuf)
+    image = do_get_appimage(app_name, icondata, menu_icon_size)
+    if image:
+        pixbuf = image.get_pixbuf()
+        if pixbuf:
+            _APPIMAGE_CACHE[key] = pixbuf
+            while len(_APPIMAGE_CACHE) > _APPIMAGE_CACHE_SIZE:
+                _APPIMAGE_CACHE.popitem(last=False)
+    return image
+
+
+def do_get_appimage(app_name, icondata=None, menu_icon_size=24) -> Gtk.Image | None:
     pixbuf = None
     if app_name and not icondata:
         # try to load from our icons:
         nstr = bytestostr(app_name).lower()
-        icon_filename = os.path.join(get_icon_dir(), "%s.png" % nstr)
-        if os.path.exists(icon_filename):
+        if f"{nstr}.png" in get_icon_filenames():
+            icon_filename = os.path.join(get_icon_dir(), "%s.png" % nstr)
             pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename=icon_filename)
 
     def err(e):
@@ -120,9 +176,9 @@ def get_appimage(app_name, icondata=None, menu_icon_size=24) -> Gtk.Image | None
             pixbuf = load_pixbuf(icondata)
         except Exception as e:
             log("pixbuf loader failed", exc_info=True)
-            if re.findall(INKSCAPE_RE, icondata):
+            if INKSCAPE_PATTERN.search(icondata) is not None:
                 try:
-                    pixbuf = load_pixbuf(re.sub(INKSCAPE_RE, b"", icondata))
+                    pixbuf = load_pixbuf(INKSCAPE_PATTERN.sub(b"", icondata))
                 except Exception:
                     # there is almost no chance pillow will be able to load it
                     # (it doesn't even have svg support at time of writing)
@@ -151,42 +207,26 @@ def get_appimage(app_name, icondata=None, menu_icon_size=24) -> Gtk.Image | None
 def ensure_item_selected(submenu, item, recurse=True):
     if not isinstance(item, Gtk.CheckMenuItem):
         return None
-    if item.get_active():
-        # deactivate all except this one
-        def deactivate(items, skip=None):
-            for x in items:
-                if x == skip:
-                    continue
-                if isinstance(x, Gtk.MenuItem):
-                    submenu = x.get_submenu()
-                    if submenu and recurse:
-                        deactivate(submenu.get_children(), skip)
-                if isinstance(x, Gtk.CheckMenuItem):
-                    if x != item and x.get_active():
-                        x.set_active(False)
-
-        deactivate(submenu.get_children(), item)
-        return item
-
-    # ensure there is at least one other active item
-
-    def get_active_item(items):
-        for x in items:
-            if isinstance(x, Gtk.MenuItem):
-                submenu = x.get_submenu()
-                if submenu:
-                    a = get_active_item(submenu.get_children())
-                    if a:
-                        return a
-            if isinstance(x, Gtk.CheckMenuItem) and x.get_active():
+    deactivate_others = item.get_active()
+    # walk the menu tree with an explicit stack,
+    # so that deep menus don't pay the recursion overhead:
+    stack = list(submenu.get_children())
+    while stack:
+        x = stack.pop()
+        if x == item:
+            continue
+        if isinstance(x, Gtk.MenuItem):
+            xsub = x.get_submenu()
+            if xsub and (recurse or not deactivate_others):
+                stack.extend(xsub.get_children())
+        if isinstance(x, Gtk.CheckMenuItem) and x.get_active():
+            if not deactivate_others:
+                # there is at least one other active item, keep it:
                 return x
-        return None
-
-    active = get_active_item(submenu.get_children())
-    if active:
-        return active
-    # if not then keep this one active:
-    item.set_active(True)
+            x.set_active(False)
+    if not deactivate_others:
+        # no other active item found, keep this one active:
+        item.set_active(True)
     return item
 
 
@@ -212,12 +252,17 @@ def make_min_auto_menu(title, min_options, options,
     def populate_menu(options, value, set_fn):
         found_match = False
         items = {}
+        local_options = options
         if value and value > 0 and value not in options:
-            options[value] = f"{value}%"
-        for s in sorted(options.keys()):
-            t = options.get(s)
+            # show the current value in the menu,
+            # in a local copy so the shared options dict is not polluted:
+            local_options = dict(sorted((options | {value: f"{value}%"}).items()))
+        # the options dicts are already sorted by value,
+        # so they can be iterated directly:
+        for s, t in local_options.items():
             qi = Gtk.CheckMenuItem(label=t)
             qi.set_draw_as_radio(True)
+            qi.xpra_value = s
             candidate_match = s >= max(0, value)
             qi.set_active(not found_match and candidate_match)
             found_match |= candidate_match
@@ -232,11 +277,7 @@ def make_min_auto_menu(title, min_options, options,
         if not item.get_active():
             return
         # user selected a new value from the menu:
-        s = -1
-        for ts, tl in options.items():
-            if tl == item.get_label():
-                s = ts
-                break
+        s = getattr(item, "xpra_value", -1)
         if s >= 0 and s != ss.get_current_value():
             log("setting %s to %s", title, s)
             ss.set_value_cb(s)
@@ -260,11 +301,7 @@ def make_min_auto_menu(title, min_options, options,
         if not item.get_active():
             return
         # user selected a new min-value from the menu:
-        s = -1
-        for ts, tl in min_options.items():
-            if tl == item.get_label():
-                s = ts
-                break
+        s = getattr(item, "xpra_value", -1)
         if s >= 0 and s != ss.get_current_min_value():
             log(f"setting min-{title} to {s}")
             ss.set_min_value_cb(s)
@@ -295,14 +332,12 @@ def make_encodingsmenu(get_current_encoding, set_encoding, encodings, server_enc
 
 
 def populate_encodingsmenu(encodings_submenu, get_current_encoding, set_encoding, encodings, server_encodings):
-    from xpra.codecs.loader import get_encoding_help, get_encoding_name
     encodings_submenu.get_current_encoding = get_current_encoding
     encodings_submenu.set_encoding = set_encoding
     encodings_submenu.encodings = encodings
     encodings_submenu.server_encodings = server_encodings
     encodings_submenu.index_to_encoding = {}
     encodings_submenu.encoding_to_index = {}
-    NAME_TO_ENCODING = {}
     for i, encoding in enumerate(encodings):
         if encoding == "-":
             encodings_submenu.append(Gtk.SeparatorMenuItem())
@@ -316,8 +351,10 @@ def populate_encodingsmenu(encodings_submenu, get_current_encoding, set_encoding
             continue
         name = get_encoding_name(encoding)
         descr = get_encoding_help(encoding)
-        NAME_TO_ENCODING[name] = encoding
         encoding_item = Gtk.CheckMenuItem(label=name)
+        # keep the encoding on the menu item itself,
+        # so the callback does not need a reverse name lookup:
+        encoding_item.xpra_encoding = encoding
         if descr:
             if encoding not in server_encodings:
                 descr += "\n(not available on this server)"
@@ -325,7 +362,7 @@ def populate_encodingsmenu(encodings_submenu, get_current_encoding, set_encoding
 
         def encoding_changed(item):
             ensure_item_selected(encodings_submenu, item)
-            enc = NAME_TO_ENCODING.get(item.get_label())
+            enc = getattr(item, "xpra_encoding", None)
             log("encoding_changed(%s) enc=%s, current=%s", item, enc, encodings_submenu.get_current_encoding())
             if enc is not None and encodings_submenu.get_current_encoding() != enc:
                 encodings_submenu.set_encoding(enc)